@@ -6,25 +6,55 @@ import queue
 import time
 import re
 import json
-from concurrent.futures import ThreadPoolExecutor, wait
+import copy
+import importlib.util
+import uuid
+import asyncio
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from multiprocessing.connection import wait as wait_sentinels
 from flask import Flask, request, jsonify, send_from_directory
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.security import generate_password_hash, check_password_hash
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+import ahocorasick
+from transformers import AutoTokenizer, AutoModelForCausalLM, CompileConfig, DynamicCache
 import torch
+import torch.multiprocessing as mp
 
 # -------------------------------
 # CONFIGURATION
 # -------------------------------
 MODEL_ID = "Qwen/Qwen3-4B-Instruct-2507"
+QUANTIZED_MODEL_ID = "Qwen/Qwen3-4B-Instruct-2507-AWQ"  # AWQ INT4 weights of MODEL_ID
 DB_PATH = "ofsocial.db"
+DB_POOL_SIZE = 4  # Long-lived connections shared by all request/worker threads
 STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
 MAX_POST_LEN = 750
 MAX_COMMENT_LEN = 750
 NUM_AI_POSTS = 2
 
+# Pagination (keyset on id)
+POSTS_PAGE_SIZE = 20
+COMMENTS_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+# Inference backend: "hf" (transformers, one model per GPU) or "vllm" (continuous batching)
+INFERENCE_BACKEND = "hf"
+VLLM_MAX_NUM_SEQS = 32
+
+# Batched comment decode: static KV cache + torch.compile "reduce-overhead" (CUDA graphs).
+# Off by default: the AWQ GEMM ops break the graph at every quantized linear, so a step is
+# never one captured graph, and each new batch shape costs another compile and recording.
+USE_CUDA_GRAPHS = False
+PROMPT_BUCKET = 64  # Pad batch prompts to a multiple of this so captured graphs get reused
+
 # Parallel processing config
-MAX_WORKERS_PER_GPU = 1  # Adjust based on GPU memory (2-4 recommended)
+GENERATION_TIMEOUT = 300  # Seconds a caller waits on a model worker before giving up
+
+# Persona edits are buffered this many seconds before personas.json is rewritten
+PERSONA_FLUSH_DELAY = 2.0
 
 # Admin credentials (hardcoded)
 ADMIN_USER = "admin"
@@ -46,6 +76,37 @@ ARTIFACT_PATTERNS = [
     r"Be .{0,30}\.",
 ]
 
+# Compiled once at import; clean_content runs on every generated post/comment
+# Applied one after another in list order: a later pattern must see the text an earlier one left
+_ARTIFACT_RES = [re.compile(pattern, re.IGNORECASE) for pattern in ARTIFACT_PATTERNS]
+_BRACKET_RE = re.compile(r"\[[^\]]+\]")
+_INSTR_RE = re.compile(r"\([^\)]*instructions[^\)]*\)", re.IGNORECASE)
+_WS_RE = re.compile(r"\s+")
+_SENT_END_RE = re.compile(r"[.!?]")
+
+def build_keyword_matcher(words):
+    """Aho-Corasick automaton over lowercase keywords: one scan finds any of them"""
+    automaton = ahocorasick.Automaton()
+    for word in words:
+        automaton.add_word(word, word)
+    automaton.make_automaton()
+    return automaton
+
+def contains_any(matcher, text):
+    """True if any matcher keyword occurs in already-lowercased text"""
+    return next(matcher.iter(text), None) is not None
+
+# Leftover instruction keywords that reject a cleaned post / comment
+_INSTRUCTION_MATCHER = build_keyword_matcher(['include', 'use at least', 'write a', 'post:'])
+_POST_ARTIFACT_MATCHER = build_keyword_matcher(['no hashtags', 'include', 'use at least', 'write a comment', 'post:'])
+_COMMENT_ARTIFACT_MATCHER = build_keyword_matcher(['include', 'use', 'write a comment'])
+# Literal anchors of ARTIFACT_PATTERNS, the bracket/instruction regexes and _INSTRUCTION_MATCHER:
+# text without any of them passes through clean_content's removal steps unchanged
+_CLEAN_PROBE_MATCHER = build_keyword_matcher([
+    'no hashtags', 'include', 'use ', 'story', 'no passive voice', 'keep it under',
+    'write a', 'as ', 'be ', '[', 'instructions', 'post:',
+])
+
 # -------------------------------
 # PERSISTENT PERSONA STORAGE
 # -------------------------------
@@ -58,6 +119,9 @@ class PersonaManager:
             {"name": "Dr. Morgan", "style": "Academic tone, analytical, cites studies naturally"},
             {"name": "Charlie", "style": "Sarcastic internet troll, uses slang, contrarian"},
         ]
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flush_timer = None
         self.load_personas()
     
     def load_personas(self):
@@ -69,8 +133,37 @@ class PersonaManager:
             self.save_personas()
     
     def save_personas(self):
-        with open(self.db_path, 'w') as f:
-            json.dump(self.personas, f, indent=2)
+        """Mark personas dirty; one delayed flush covers every edit made meanwhile"""
+        with self._lock:
+            self._dirty = True
+            self._schedule_flush()
+    
+    def _schedule_flush(self):
+        """Start the delayed flush unless one is already pending; caller holds the lock"""
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(PERSONA_FLUSH_DELAY, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+    
+    def flush(self):
+        """Write personas to disk if dirty, via fsync'd temp file + atomic rename"""
+        with self._lock:
+            self._flush_timer = None
+            if not self._dirty:
+                return
+            tmp_path = self.db_path + ".tmp"
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(list(self.personas), f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.db_path)
+            except OSError as e:
+                # Still dirty: retry later, and the exit-time flush tries again too
+                print(f"❌ Failed to save personas: {e}")
+                self._schedule_flush()
+                return
+            self._dirty = False
     
     def get_all(self):
         return self.personas
@@ -92,98 +185,389 @@ class PersonaManager:
 # -------------------------------
 # MODEL MANAGER
 # -------------------------------
+def select_attn_implementation(device):
+    """FlashAttention-2 when installed on an Ampere+ GPU, fused PyTorch SDPA otherwise"""
+    if importlib.util.find_spec("flash_attn") is not None and torch.cuda.get_device_capability(device)[0] >= 8:
+        return "flash_attention_2"
+    return "sdpa"
+
+def load_tokenizer():
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, trust_remote_code=True)
+    # Left padding keeps generated tokens contiguous at the end of each batch row
+    tokenizer.padding_side = "left"
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+class ModelWorker:
+    """One model on one GPU; lives in its own process and serves requests one at a time"""
+    def __init__(self, worker_id):
+        self.tokenizer = load_tokenizer()
+        # The parent process restricts CUDA_VISIBLE_DEVICES to this worker's GPU
+        self.device = torch.device("cuda:0")
+        
+        attn_impl = select_attn_implementation(self.device)
+        print(f"📦 Loading Model {worker_id+1} ({attn_impl})...")
+        start = time.time()
+        # INT4 weight-only AWQ checkpoint: the quantization config ships with the weights
+        self.model = AutoModelForCausalLM.from_pretrained(
+            QUANTIZED_MODEL_ID,
+            device_map={"": self.device.index},
+            trust_remote_code=True,
+            torch_dtype=torch.float16,
+            attn_implementation=attn_impl,
+        ).eval()
+        print(f"✅ Model {worker_id+1} loaded in {time.time()-start:.1f}s")
+        
+        # Decode-step graphs are captured per (batch size, cache length) shape
+        self.compile_config = CompileConfig(mode="reduce-overhead", fullgraph=False)
+        
+        # Shared prompt prefixes: token ids and prefilled KV cache per prefix
+        self._prefix_ids = {}
+        self._prefix_kv = {}
+        self._get_prefix(POST_SYSTEM_PROMPT)
+    
+    @staticmethod
+    def _to_device(inputs, device):
+        """Stage tokenizer tensors in pinned memory so the H2D copy doesn't block the host"""
+        return {k: v.pin_memory().to(device, non_blocking=True) for k, v in inputs.items()}
+    
+    def _get_prefix(self, prefix):
+        """Token ids and prefilled KV cache for a prompt prefix, computed on first use"""
+        if prefix not in self._prefix_kv:
+            ids = self.tokenizer(prefix, return_tensors="pt", add_special_tokens=False).input_ids
+            cache = DynamicCache()
+            with torch.inference_mode():
+                self.model(input_ids=ids.to(self.device), past_key_values=cache, use_cache=True)
+            self._prefix_ids[prefix] = ids
+            self._prefix_kv[prefix] = cache
+        
+        return self._prefix_ids[prefix], self._prefix_kv[prefix]
+    
+    def generate(self, prompt, max_tokens=300, temperature=0.8, prefix=None):
+        """Generation; an optional shared `prefix` skips re-tokenizing and re-prefilling it"""
+        if prefix is None:
+            inputs = self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=2048)
+            prefix_kv = None
+        else:
+            prefix_ids, prefix_kv = self._get_prefix(prefix)
+            suffix_ids = self.tokenizer(
+                prompt, return_tensors="pt", add_special_tokens=False,
+                truncation=True, max_length=2048 - prefix_ids.shape[-1],
+            ).input_ids
+            input_ids = torch.cat([prefix_ids, suffix_ids], dim=-1)
+            inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        inputs = self._to_device(inputs, self.device)
+        
+        with torch.inference_mode():
+            # generate() extends the cache in place, so each call decodes on a copy.
+            # The prefix KV holds inference tensors, so the copy is made in inference mode too.
+            past_key_values = copy.deepcopy(prefix_kv) if prefix_kv is not None else None
+            outputs = self.model.generate(
+                **inputs,
+                past_key_values=past_key_values,
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                do_sample=True,
+                top_p=0.95,
+                repetition_penalty=1.15,
+                pad_token_id=self.tokenizer.eos_token_id,
+            )
+        
+        generated = outputs[0][inputs["input_ids"].shape[-1]:]
+        return self.tokenizer.decode(generated, skip_special_tokens=True)
+    
+    def generate_batch(self, prompts, max_tokens=300, temperature=0.8, prefix_ids=None):
+        """Batched generation: one decode for all prompts, after optional pre-tokenized per-row prefixes"""
+        pad_multiple = PROMPT_BUCKET if USE_CUDA_GRAPHS else None
+        
+        if prefix_ids is None:
+            inputs = self.tokenizer(
+                prompts, return_tensors="pt", padding=True, truncation=True, max_length=2048,
+                pad_to_multiple_of=pad_multiple,
+            )
+        else:
+            suffixes = self.tokenizer(prompts, add_special_tokens=False).input_ids
+            rows = [(list(prefix) + suffix)[:2048] for prefix, suffix in zip(prefix_ids, suffixes)]
+            inputs = self.tokenizer.pad({"input_ids": rows}, padding=True, pad_to_multiple_of=pad_multiple, return_tensors="pt")
+        inputs = self._to_device(inputs, self.device)
+        graph_kwargs = {"cache_implementation": "static", "compile_config": self.compile_config} if USE_CUDA_GRAPHS else {}
+        
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                **graph_kwargs,
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                do_sample=True,
+                top_p=0.95,
+                repetition_penalty=1.15,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        
+        # Prompts are left-padded, so every row's completion starts at the same offset
+        generated = outputs[:, inputs["input_ids"].shape[-1]:]
+        return self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+
+def _model_worker_main(worker_id, gpu_index, requests, replies):
+    """Model process entry point: load onto one GPU, then serve (request_id, method, args, kwargs)"""
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_index)
+    try:
+        worker = ModelWorker(worker_id)
+    except Exception as e:
+        replies.put((None, worker_id, str(e)))
+        return
+    replies.put((None, worker_id, None))
+    
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, method, args, kwargs = request
+        try:
+            replies.put((request_id, True, getattr(worker, method)(*args, **kwargs)))
+        except Exception as e:
+            replies.put((request_id, False, str(e)))
+
 class DualModelManager:
+    """Runs each model in its own spawned process so GPUs never share a CUDA context or the GIL"""
     def __init__(self):
         print("🤖 Loading tokenizer...")
-        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, trust_remote_code=True)
+        self.tokenizer = load_tokenizer()
         
-        bnb_config = BitsAndBytesConfig(load_in_8bit=True)
         gpu_count = torch.cuda.device_count()
         
         if gpu_count >= 2:
-            self.devices = [torch.device("cuda:0"), torch.device("cuda:1")]
+            gpu_indices = [0, 1]
             print(f"✅ Found {gpu_count} GPUs. Using cuda:0 and cuda:1")
         elif gpu_count == 1:
-            self.devices = [torch.device("cuda:0"), torch.device("cuda:0")]
+            gpu_indices = [0, 0]
             print("⚠️ Only 1 GPU detected. Models will share cuda:0")
         else:
             raise RuntimeError("❌ No CUDA GPUs found!")
         
-        self.models = []
-        self.locks = []
-        for i, dev in enumerate(self.devices):
-            print(f"📦 Loading Model {i+1} on {dev}...")
-            start = time.time()
-            model = AutoModelForCausalLM.from_pretrained(
-                MODEL_ID,
-                quantization_config=bnb_config,
-                device_map={"": dev.index},
-                trust_remote_code=True,
-                torch_dtype=torch.float16,
-            ).eval()
-            self.models.append(model)
-            self.locks.append(threading.Lock())
-            print(f"✅ Model {i+1} loaded in {time.time()-start:.1f}s")
-    
-    def generate(self, prompt, max_tokens=300, temperature=0.8, model_id=0):
-        """Thread-safe generation with better parameters"""
-        model = self.models[model_id]
-        lock = self.locks[model_id]
-        device = self.devices[model_id]
+        ctx = mp.get_context("spawn")
+        self._replies = ctx.Queue()
+        self._pending = {}  # request_id -> (model_id, future)
+        self._pending_lock = threading.Lock()
+        self._dead = set()  # model_ids whose process has exited
+        self._closing = False
+        self.queues = []
+        self.models = []  # One worker process per model
+        # Each process serves one request at a time, so a second consumer thread per GPU would only
+        # take tasks off the shared comment queue and leave them waiting behind the busy GPU
+        self.workers_per_model = 1
+        for i, gpu_index in enumerate(gpu_indices):
+            requests = ctx.Queue()
+            # Not daemonic: torch.compile spawns its own compile workers
+            process = ctx.Process(
+                target=_model_worker_main,
+                args=(i, gpu_index, requests, self._replies),
+                name=f"model_worker_{i}",
+            )
+            process.start()
+            self.queues.append(requests)
+            self.models.append(process)
         
-        with lock:
-            inputs = self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=2048)
-            inputs = {k: v.to(device) for k, v in inputs.items()}
-            
-            with torch.no_grad():
-                outputs = model.generate(
-                    **inputs,
-                    max_new_tokens=max_tokens,
-                    temperature=temperature,
-                    do_sample=True,
-                    top_p=0.95,
-                    repetition_penalty=1.15,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                )
-            
-            generated = outputs[0][inputs["input_ids"].shape[-1]:]
-            return self.tokenizer.decode(generated, skip_special_tokens=True)
+        ready = set()
+        while len(ready) < len(self.models):
+            try:
+                _, worker_id, error = self._replies.get(timeout=1.0)
+            except queue.Empty:
+                # A worker killed while loading (OOM, segfault) never replies
+                for i, process in enumerate(self.models):
+                    if i not in ready and not process.is_alive():
+                        self.shutdown()
+                        raise RuntimeError(f"❌ Model {i+1} exited with code {process.exitcode} while loading")
+                continue
+            if error:
+                self.shutdown()
+                raise RuntimeError(f"❌ Model {worker_id+1} failed to load: {error}")
+            ready.add(worker_id)
+        
+        self._reply_thread = threading.Thread(target=self._dispatch_replies, name="model_replies", daemon=True)
+        self._reply_thread.start()
+        self._watch_thread = threading.Thread(target=self._watch_workers, name="model_watch", daemon=True)
+        self._watch_thread.start()
+    
+    def _dispatch_replies(self):
+        """Resolve the caller's future for every reply coming back from the workers"""
+        while True:
+            reply = self._replies.get()
+            if reply is None:
+                break
+            request_id, ok, result = reply
+            with self._pending_lock:
+                entry = self._pending.pop(request_id, None)
+            if entry is None:
+                continue  # Caller already timed out or its worker was declared dead
+            _, future = entry
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+    
+    def _watch_workers(self):
+        """Fail every pending request of a worker process as soon as it exits"""
+        alive = {process.sentinel: i for i, process in enumerate(self.models)}
+        while alive and not self._closing:
+            for sentinel in wait_sentinels(list(alive), timeout=1.0):
+                model_id = alive.pop(sentinel)
+                self.models[model_id].join()  # Reap it so exitcode is set
+                exitcode = self.models[model_id].exitcode
+                if not self._closing:
+                    print(f"❌ Model {model_id+1} worker exited with code {exitcode}")
+                with self._pending_lock:
+                    self._dead.add(model_id)
+                    lost = [rid for rid, (mid, _) in self._pending.items() if mid == model_id]
+                    futures = [self._pending.pop(rid)[1] for rid in lost]
+                for future in futures:
+                    future.set_exception(RuntimeError(f"Model {model_id+1} worker exited with code {exitcode}"))
+    
+    def _call(self, model_id, method, *args, **kwargs):
+        """Run a ModelWorker method in model `model_id`'s process and wait for the result"""
+        request_id = uuid.uuid4().hex
+        future = Future()
+        with self._pending_lock:
+            if model_id in self._dead:
+                raise RuntimeError(f"Model {model_id+1} worker is not running")
+            self._pending[request_id] = (model_id, future)
+        self.queues[model_id].put((request_id, method, args, kwargs))
+        try:
+            return future.result(timeout=GENERATION_TIMEOUT)
+        except FutureTimeout:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise TimeoutError(f"Model {model_id+1} did not answer {method} within {GENERATION_TIMEOUT}s")
+    
+    def generate(self, prompt, max_tokens=300, temperature=0.8, model_id=0, prefix=None):
+        """Thread-safe generation; the worker process serves one request at a time"""
+        return self._call(model_id, "generate", prompt, max_tokens, temperature, prefix=prefix)
+    
+    def generate_batch(self, prompts, max_tokens=300, temperature=0.8, model_id=0, prefix_ids=None):
+        """Thread-safe batched generation on model `model_id`"""
+        return self._call(model_id, "generate_batch", prompts, max_tokens, temperature, prefix_ids=prefix_ids)
+    
+    def shutdown(self):
+        """Stop the worker processes and the reply dispatcher"""
+        self._closing = True
+        for requests in self.queues:
+            requests.put(None)
+        for process in self.models:
+            process.join(timeout=10)
+        self._replies.put(None)
+
+class VLLMModelManager:
+    """vLLM AsyncLLMEngine backend; the engine's scheduler batches concurrent requests"""
+    def __init__(self):
+        from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+        self._sampling_params = SamplingParams
+        
+        print("🤖 Loading tokenizer...")
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, trust_remote_code=True)
+        
+        gpu_count = torch.cuda.device_count()
+        if gpu_count == 0:
+            raise RuntimeError("❌ No CUDA GPUs found!")
+        tensor_parallel = 2 if gpu_count >= 2 else 1
+        print(f"✅ Found {gpu_count} GPUs. Using tensor_parallel_size={tensor_parallel}")
+        
+        # Engine coroutines run on a dedicated loop so Flask/worker threads can submit to it
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, name="vllm_loop", daemon=True)
+        self._loop_thread.start()
+        
+        print(f"📦 Loading vLLM engine for {QUANTIZED_MODEL_ID}...")
+        start = time.time()
+        self.engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(
+            model=QUANTIZED_MODEL_ID,
+            tokenizer=MODEL_ID,
+            quantization="awq",
+            tensor_parallel_size=tensor_parallel,
+            gpu_memory_utilization=0.85,
+            max_num_seqs=VLLM_MAX_NUM_SEQS,
+            enable_prefix_caching=True,  # reuses KV blocks of shared system prompts
+            trust_remote_code=True,
+        ))
+        # A single engine spans all GPUs, so callers see one "model"
+        self.models = [self.engine]
+        # Continuous batching only helps if enough requests are in flight at once
+        self.workers_per_model = VLLM_MAX_NUM_SEQS
+        print(f"✅ vLLM engine loaded in {time.time()-start:.1f}s")
+    
+    def generate(self, prompt, max_tokens=300, temperature=0.8, model_id=0, prefix=None):
+        """Thread-safe generation; blocks until the engine finishes this request"""
+        # Automatic prefix caching finds the shared prefix blocks on its own
+        return self.generate_batch([(prefix or "") + prompt], max_tokens, temperature, model_id)[0]
+    
+    def generate_batch(self, prompts, max_tokens=300, temperature=0.8, model_id=0, prefix_ids=None):
+        """Thread-safe batched generation: prompts are scheduled as concurrent requests"""
+        params = self._sampling_params(
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=0.95,
+            repetition_penalty=1.15,
+        )
+        if prefix_ids is not None:
+            suffixes = self.tokenizer(prompts, add_special_tokens=False).input_ids
+            prompts = [{"prompt_token_ids": list(prefix) + suffix} for prefix, suffix in zip(prefix_ids, suffixes)]
+        future = asyncio.run_coroutine_threadsafe(self._generate_all(prompts, params), self.loop)
+        return future.result()
+    
+    def shutdown(self):
+        """Stop the engine's event loop"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+    
+    async def _generate_all(self, prompts, params):
+        return await asyncio.gather(*(self._generate_one(prompt, params) for prompt in prompts))
+    
+    async def _generate_one(self, prompt, params):
+        final = None
+        async for output in self.engine.generate(prompt, params, request_id=uuid.uuid4().hex):
+            final = output
+        return final.outputs[0].text
 
 # -------------------------------
 # CONTENT CLEANING & GENERATION
 # -------------------------------
+def _first_sentence(text):
+    """First complete sentence or meaningful chunk (scan stops at the first terminator)"""
+    end = _SENT_END_RE.search(text)
+    first = text[:end.start()] if end else text
+    return first + '.' if len(first) > 20 else text
+
 def clean_content(text):
     """Aggressively remove prompt artifacts and instructions"""
     original = text
     
+    # Fast path: none of the patterns' literal anchors occur, so only trimming applies
+    normalized = _WS_RE.sub(' ', text).strip()
+    if not contains_any(_CLEAN_PROBE_MATCHER, normalized.lower()):
+        return _first_sentence(normalized)
+    
     # Remove patterns
-    for pattern in ARTIFACT_PATTERNS:
-        text = re.sub(pattern, "", text, flags=re.IGNORECASE)
+    for pattern in _ARTIFACT_RES:
+        text = pattern.sub("", text)
     
     # Remove bracketed instructions
-    text = re.sub(r"\[[^\]]+\]", "", text)
-    text = re.sub(r"\([^\)]*instructions[^\)]*\)", "", text, flags=re.IGNORECASE)
+    text = _BRACKET_RE.sub("", text)
+    text = _INSTR_RE.sub("", text)
     
     # Remove multiple spaces and newlines
-    text = re.sub(r'\s+', ' ', text).strip()
+    text = _WS_RE.sub(' ', text).strip()
     
-    # Take first complete sentence or meaningful chunk
-    sentences = re.split(r'[.!?]+', text)
-    if sentences and len(sentences[0]) > 20:
-        text = sentences[0] + '.'
+    text = _first_sentence(text)
     
     # If still contains obvious instructions, return first line only
-    if any(word in text.lower() for word in ['include', 'use at least', 'write a', 'post:']):
+    if contains_any(_INSTRUCTION_MATCHER, text.lower()):
         lines = [l.strip() for l in original.split('\n') if l.strip() and len(l) > 20]
         if lines:
             text = lines[0]
     
     return text.strip()
 
-def generate_post_content(topic, model_id=0):
-    """Generate clean social media post"""
-    prompt = f"""<|im_start|>system
-You are a social media user. Write a natural post about "{topic}".
+# Topic-free so every post shares this prefix and its cached KV
+POST_SYSTEM_PROMPT = """<|im_start|>system
+You are a social media user. Write a natural post about the topic you are given.
 Rules:
 - Write in your own voice, with personal opinion
 - Keep it conversational
@@ -191,50 +575,79 @@ Rules:
 - Do NOT mention "No hashtags" or any rules
 - Just write the post content
 <|im_end|>
-<|im_start|>user
+"""
+
+def generate_post_content(topic, model_id=0):
+    """Generate clean social media post"""
+    prompt = f"""<|im_start|>user
 Write a post about: {topic}
 <|im_end|>
 <|im_start|>assistant
 """
     
     for attempt in range(2):
-        raw = model_manager.generate(prompt, max_tokens=400, temperature=0.85, model_id=model_id)
+        raw = model_manager.generate(prompt, max_tokens=400, temperature=0.85, model_id=model_id, prefix=POST_SYSTEM_PROMPT)
         cleaned = clean_content(raw)
         
-        if cleaned and len(cleaned) > 30 and not any(artifact in cleaned.lower() for artifact in ['no hashtags', 'include', 'use at least', 'write a comment', 'post:']):
+        if cleaned and len(cleaned) > 30 and not contains_any(_POST_ARTIFACT_MATCHER, cleaned.lower()):
             return cleaned[:MAX_POST_LEN]
         
         print(f"⚠️ Post artifact detected, retrying... (attempt {attempt + 1})")
     
     return cleaned[:MAX_POST_LEN] if cleaned else f"I've been thinking about {topic} lately..."
 
-def generate_comment_content(post_content, persona, model_id=0):
-    """Generate clean comment with persona"""
-    prompt = f"""<|im_start|>system
-You are {persona['name']}. Your communication style: {persona['style']}
+def build_comment_system_prompt(name, style):
+    """System block for a persona; depends only on the persona, never on the post"""
+    return f"""<|im_start|>system
+You are {name}. Your communication style: {style}
 Rules:
 - Respond naturally to the post
 - Do NOT include instructions or meta-commentary
 - Do NOT mention "No hashtags" or any rules
 - Just write the comment content
 <|im_end|>
-<|im_start|>user
+"""
+
+@lru_cache(maxsize=32)
+def persona_prefix_ids(name, style):
+    """Token ids of a persona's system block, keyed on its content so admin edits miss the cache"""
+    return tuple(model_manager.tokenizer(build_comment_system_prompt(name, style), add_special_tokens=False).input_ids)
+
+def build_comment_prompt(post_content, persona):
+    """Per-post part of a comment prompt, appended to the persona's system block"""
+    return f"""<|im_start|>user
 Post: "{post_content}"
 Write a natural comment as {persona['name']}.
 <|im_end|>
 <|im_start|>assistant
 """
+
+def generate_comment_batch(post_content, personas, model_id=0):
+    """Generate clean comments for several personas in one batched decode"""
+    prompts = [build_comment_prompt(post_content, persona) for persona in personas]
+    prefixes = [persona_prefix_ids(persona['name'], persona['style']) for persona in personas]
+    comments = [""] * len(personas)
+    pending = list(range(len(personas)))
     
     for attempt in range(2):
-        raw = model_manager.generate(prompt, max_tokens=200, temperature=0.9, model_id=model_id)
-        cleaned = clean_content(raw)
+        raws = model_manager.generate_batch(
+            [prompts[i] for i in pending], max_tokens=200, temperature=0.9, model_id=model_id,
+            prefix_ids=[prefixes[i] for i in pending],
+        )
+        retry = []
+        for i, raw in zip(pending, raws):
+            cleaned = clean_content(raw)
+            comments[i] = cleaned
+            if not (cleaned and len(cleaned) > 15 and not contains_any(_COMMENT_ARTIFACT_MATCHER, cleaned.lower())):
+                retry.append(i)
         
-        if cleaned and len(cleaned) > 15 and not any(artifact in cleaned.lower() for artifact in ['include', 'use', 'write a comment']):
-            return cleaned[:MAX_COMMENT_LEN]
+        if not retry:
+            break
         
-        print(f"⚠️ Comment artifact detected, retrying... (attempt {attempt + 1})")
+        print(f"⚠️ Comment artifact detected in {len(retry)} comment(s), retrying... (attempt {attempt + 1})")
+        pending = retry
     
-    return cleaned[:MAX_COMMENT_LEN] if cleaned else "Interesting post!"
+    return [cleaned[:MAX_COMMENT_LEN] if cleaned else "Interesting post!" for cleaned in comments]
 
 # -------------------------------
 # PARALLEL EXECUTION
@@ -244,54 +657,70 @@ class ParallelCommentGenerator:
         self.model_manager = model_manager
         self.persona_manager = persona_manager
         self.db = db
-        self.executor = None
-        self._lock = threading.Lock()
-        self._initialize_executor()
+        self.work_q = queue.Queue()
+        self.workers = []
+        self._initialize_workers()
     
-    def _initialize_executor(self):
-        """Initialize thread pool executor with optimal worker count"""
+    def _initialize_workers(self):
+        """Start consumer threads bound to GPUs; each pulls the next task when its GPU is free"""
         num_gpus = len(self.model_manager.models)
-        max_workers = num_gpus * MAX_WORKERS_PER_GPU
-        self.executor = ThreadPoolExecutor(
-            max_workers=max_workers,
-            thread_name_prefix="comment_worker"
-        )
-        print(f"🚀 Initialized parallel executor: {max_workers} workers ({MAX_WORKERS_PER_GPU} per GPU)")
+        workers_per_model = self.model_manager.workers_per_model
+        for i in range(num_gpus * workers_per_model):
+            worker = threading.Thread(
+                target=self._worker_loop,
+                args=(i % num_gpus,),
+                name=f"comment_worker_{i}",
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+        print(f"🚀 Initialized comment queue: {len(self.workers)} workers ({workers_per_model} per model)")
     
     def submit_post_comments(self, post_id, post_content):
-        """Submit all comment generation tasks for a post in parallel"""
+        """Queue a post's personas as one batched task per GPU's share"""
         active_personas = self.persona_manager.get_all()
+        if not active_personas:
+            return []
+        
+        num_gpus = len(self.model_manager.models)
+        chunk = -(-len(active_personas) // num_gpus)
         futures = []
         
-        for i, persona in enumerate(active_personas):
-            device_id = i % len(self.model_manager.models)
-            
-            # Submit each comment as separate task
-            future = self.executor.submit(
-                self._generate_single_comment,
-                post_id=post_id,
-                post_content=post_content,
-                persona=persona,
-                device_id=device_id
-            )
+        for start in range(0, len(active_personas), chunk):
+            # Whichever GPU frees up first takes the next chunk
+            future = Future()
+            self.work_q.put((post_id, post_content, active_personas[start:start + chunk], future))
             futures.append(future)
         
         return futures
     
-    def _generate_single_comment(self, post_id, post_content, persona, device_id):
-        """Generate a single comment and save to DB"""
+    def _worker_loop(self, device_id):
+        while True:
+            task = self.work_q.get()
+            if task is None:
+                break
+            self._generate_comment_batch(*task, device_id=device_id)
+    
+    def _generate_comment_batch(self, post_id, post_content, personas, future, device_id):
+        """Generate comments for a group of personas and save to DB"""
         try:
-            comment = generate_comment_content(post_content, persona, device_id)
-            self.db.add_comment(post_id, comment, persona['name'])
-            print(f"🤖 {persona['name']} → post #{post_id} [GPU{device_id}] ✅")
+            comments = generate_comment_batch(post_content, personas, device_id)
+            self.db.add_comments([(post_id, comment, persona['name']) for persona, comment in zip(personas, comments)])
+            for persona in personas:
+                print(f"🤖 {persona['name']} → post #{post_id} [GPU{device_id}] ✅")
+            future.set_result(comments)
         except Exception as e:
             print(f"❌ Comment error [GPU{device_id}]: {e}")
+            future.set_exception(e)
     
     def shutdown(self, wait=True):
-        """Shutdown the executor gracefully"""
-        if self.executor:
-            self.executor.shutdown(wait=wait)
-            print("🛑 Parallel executor shutdown complete")
+        """Stop the workers once queued tasks are done"""
+        for _ in self.workers:
+            self.work_q.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+        print("🛑 Comment workers shutdown complete")
 
 # -------------------------------
 # DATABASE
@@ -301,21 +730,55 @@ class Database:
         db_dir = os.path.dirname(DB_PATH)
         if db_dir:
             os.makedirs(db_dir, exist_ok=True)
+        self.lock = threading.Lock()  # Serializes writers; WAL readers never wait on it
+        self._pool = queue.Queue()
+        for _ in range(DB_POOL_SIZE):
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA mmap_size=268435456")
+            self._pool.put(conn)
         self.init_db()
-        self.lock = threading.Lock()
+    
+    @contextmanager
+    def _connection(self):
+        """Borrow a pooled autocommit connection; blocks while all are in use"""
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
     
     def init_db(self):
-        with sqlite3.connect(DB_PATH) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
+            # WAL is persistent in the database file: readers no longer block writers
+            cursor.execute("PRAGMA journal_mode=WAL")
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS posts (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     content TEXT NOT NULL,
                     author TEXT NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_ai_generated BOOLEAN DEFAULT 0
+                    is_ai_generated BOOLEAN DEFAULT 0,
+                    comment_count INTEGER DEFAULT 0
                 )
             """)
+            # Databases created before comment_count existed: add and backfill it.
+            # One transaction, so a crash in between cannot leave the column with zeros for good.
+            if "comment_count" not in [r[1] for r in cursor.execute("PRAGMA table_info(posts)")]:
+                cursor.execute("BEGIN")
+                try:
+                    cursor.execute("ALTER TABLE posts ADD COLUMN comment_count INTEGER DEFAULT 0")
+                    cursor.execute("""
+                        UPDATE posts SET comment_count = (
+                            SELECT COUNT(*) FROM comments WHERE comments.post_id = posts.id
+                        )
+                    """)
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+                cursor.execute("COMMIT")
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS comments (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -327,54 +790,74 @@ class Database:
                 )
             """)
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_post_id ON comments(post_id)")
-            conn.commit()
+            # Keep posts.comment_count current so listing posts needs no join
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS trg_comment_count AFTER INSERT ON comments
+                BEGIN
+                    UPDATE posts SET comment_count = comment_count + 1 WHERE id = NEW.post_id;
+                END
+            """)
     
     def add_post(self, content, author, is_ai=False):
-        with self.lock:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT INTO posts (content, author, is_ai_generated) VALUES (?, ?, ?)",
-                    (content[:MAX_POST_LEN], author, is_ai)
-                )
-                conn.commit()
-                return cursor.lastrowid
+        with self.lock, self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO posts (content, author, is_ai_generated) VALUES (?, ?, ?)",
+                (content[:MAX_POST_LEN], author, is_ai)
+            )
+            return cursor.lastrowid
     
     def add_comment(self, post_id, content, author):
-        with self.lock:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
+        self.add_comments([(post_id, content, author)])
+    
+    def add_comments(self, rows):
+        """Insert (post_id, content, author) rows in a single transaction"""
+        with self.lock, self._connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
                     "INSERT INTO comments (post_id, content, author) VALUES (?, ?, ?)",
-                    (post_id, content[:MAX_COMMENT_LEN], author)
+                    [(post_id, content[:MAX_COMMENT_LEN], author) for post_id, content, author in rows]
                 )
-                conn.commit()
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
     
-    def get_posts(self):
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p.*, COUNT(c.id) as comment_count 
-                FROM posts p 
-                LEFT JOIN comments c ON p.id = c.post_id 
-                GROUP BY p.id 
-                ORDER BY p.created_at DESC
-            """)
-            return [{
-                "id": r[0], "content": r[1], "author": r[2], 
-                "created_at": r[3], "is_ai_generated": bool(r[4]), "comment_count": r[5]
-            } for r in cursor.fetchall()]
+    def get_posts(self, limit=POSTS_PAGE_SIZE, before_id=None):
+        """Newest posts first; pass the last id seen as `before_id` for the next page"""
+        # Separate statements: an "? IS NULL OR id < ?" predicate would defeat the rowid seek
+        with self._connection() as conn:
+            if before_id is None:
+                rows = conn.execute("""
+                    SELECT id, content, author, created_at, is_ai_generated, comment_count
+                    FROM posts
+                    ORDER BY id DESC
+                    LIMIT ?
+                """, (limit,)).fetchall()
+            else:
+                rows = conn.execute("""
+                    SELECT id, content, author, created_at, is_ai_generated, comment_count
+                    FROM posts
+                    WHERE id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                """, (before_id, limit)).fetchall()
+        return [{
+            "id": r[0], "content": r[1], "author": r[2], 
+            "created_at": r[3], "is_ai_generated": bool(r[4]), "comment_count": r[5]
+        } for r in rows]
     
-    def get_comments(self, post_id):
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT * FROM comments WHERE post_id = ? ORDER BY created_at ASC",
-                (post_id,)
-            )
-            return [{
-                "id": r[0], "post_id": r[1], "content": r[2], "author": r[3], "created_at": r[4]
-            } for r in cursor.fetchall()]
+    def get_comments(self, post_id, limit=COMMENTS_PAGE_SIZE, after_id=0):
+        """Oldest comments first; pass the last id seen as `after_id` for the next page"""
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT * FROM comments WHERE post_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (post_id, after_id, limit)
+            ).fetchall()
+        return [{
+            "id": r[0], "post_id": r[1], "content": r[2], "author": r[3], "created_at": r[4]
+        } for r in rows]
 
 # -------------------------------
 # FLASK APP
@@ -382,11 +865,12 @@ class Database:
 app = Flask(__name__, static_folder=STATIC_DIR, static_url_path='/static')
 auth = HTTPBasicAuth()
 
-# Global instances
-model_manager = DualModelManager()
-db = Database()
-persona_manager = PersonaManager()
+# Global instances, created under __main__: spawned model workers re-import this module
+model_manager = None
+db = None
+persona_manager = None
 parallel_generator = None
+post_executor = None  # Post generation runs here so a search's posts generate concurrently
 
 # Admin auth verification
 @auth.verify_password
@@ -396,9 +880,14 @@ def verify_password(username, password):
     return None
 
 # API Routes
+def page_limit(default):
+    """`limit` query arg, clamped to 1..MAX_PAGE_SIZE"""
+    return max(1, min(request.args.get('limit', default, type=int), MAX_PAGE_SIZE))
+
 @app.route('/api/posts')
 def get_posts():
-    return jsonify(db.get_posts())
+    before_id = request.args.get('before_id', type=int)
+    return jsonify(db.get_posts(page_limit(POSTS_PAGE_SIZE), before_id))
 
 @app.route('/api/posts', methods=['POST'])
 def create_post():
@@ -417,7 +906,8 @@ def create_post():
 
 @app.route('/api/posts/<int:post_id>/comments')
 def get_comments(post_id):
-    return jsonify(db.get_comments(post_id))
+    after_id = request.args.get('after_id', 0, type=int)
+    return jsonify(db.get_comments(post_id, page_limit(COMMENTS_PAGE_SIZE), after_id))
 
 @app.route('/api/posts/<int:post_id>/comments', methods=['POST'])
 def add_comment(post_id):
@@ -437,9 +927,15 @@ def search_generate():
         return jsonify({"error": "Empty query"}), 400
     
     try:
+        # Generate all posts concurrently across GPUs
+        futures = [
+            post_executor.submit(generate_post_content, query, i % len(model_manager.models))
+            for i in range(NUM_AI_POSTS)
+        ]
+        contents = [future.result() for future in futures]
+        
         ai_posts = []
-        for i in range(NUM_AI_POSTS):
-            content = generate_post_content(query, i % len(model_manager.models))
+        for i, content in enumerate(contents):
             post_id = db.add_post(content, f"AI Bot {i+1}", True)
             ai_posts.append({"id": post_id, "content": content, "author": f"AI Bot {i+1}"})
             
@@ -505,27 +1001,36 @@ def serve_index():
 import atexit
 def cleanup():
     print("\n🛑 Shutting down OfSM Server...")
+    post_executor.shutdown(wait=True)
+    persona_manager.flush()
     if parallel_generator:
         parallel_generator.shutdown(wait=True)
-    stop_event.set()
-    worker_thread.join(timeout=5)
-atexit.register(cleanup)
-
-# Initialize parallel generator after model loading
-parallel_generator = ParallelCommentGenerator(model_manager, persona_manager, db)
+    model_manager.shutdown()
 
 # -------------------------------
 # MAIN
 # -------------------------------
 if __name__ == '__main__':
+    model_manager = VLLMModelManager() if INFERENCE_BACKEND == "vllm" else DualModelManager()
+    db = Database()
+    persona_manager = PersonaManager()
+    # Room for every post of a search at once, and for concurrent searches up to the backend's capacity
+    post_executor = ThreadPoolExecutor(
+        max_workers=max(NUM_AI_POSTS, len(model_manager.models) * model_manager.workers_per_model),
+        thread_name_prefix="post_worker"
+    )
+    # Initialize parallel generator after model loading
+    parallel_generator = ParallelCommentGenerator(model_manager, persona_manager, db)
+    atexit.register(cleanup)
+    
     print("\n" + "="*70)
     print("🚀 OfSM Server Running!")
     print(f"🌐 Main App: http://localhost:5000")
     print(f"🔐 Admin Panel: http://localhost:5000/admin (user: admin, pass: admin)")
     print(f"💾 Database: {os.path.abspath(DB_PATH)}")
-    print(f"🤖 Model: {MODEL_ID}")
+    print(f"🤖 Model: {MODEL_ID} ({INFERENCE_BACKEND} backend)")
     print(f"💻 GPUs: {len(model_manager.models)} device(s)")
-    print(f"⚡ Workers per GPU: {MAX_WORKERS_PER_GPU}")
+    print(f"⚡ Workers per model: {model_manager.workers_per_model}")
     print(f"🎭 AI Personas: {len(persona_manager.get_all())}")
     print("="*70 + "\n")
     
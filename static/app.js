@@ -1,5 +1,9 @@
 const API_BASE = '/api';
 const FEED = document.getElementById('postsFeed');
+const PAGE_SIZE = 20;
+const COMMENTS_PAGE_SIZE = 50;
+let shownPosts = 0;
+let oldestPostId = null;
 
 async function apiCall(url, options = {}) {
     try {
@@ -15,20 +19,54 @@ async function apiCall(url, options = {}) {
 async function loadPosts() {
     FEED.innerHTML = '<div class="loading">Loading posts...</div>';
     try {
-        const posts = await apiCall(`${API_BASE}/posts`);
-        displayPosts(posts);
+        // Refresh re-fetches page by page, keeping every page the user has already loaded
+        const target = Math.max(PAGE_SIZE, shownPosts);
+        let posts = [];
+        let page;
+        do {
+            const cursor = posts.length ? `&before_id=${posts[posts.length - 1].id}` : '';
+            page = await apiCall(`${API_BASE}/posts?limit=${PAGE_SIZE}${cursor}`);
+            posts = posts.concat(page);
+        } while (page.length === PAGE_SIZE && posts.length < target);
+        displayPosts(posts, page.length === PAGE_SIZE);
     } catch (error) {
         FEED.innerHTML = '<div class="loading">❌ Failed to load posts. Check server.</div>';
     }
 }
 
-function displayPosts(posts) {
+async function loadMorePosts() {
+    const btn = document.getElementById('loadMoreBtn');
+    btn.disabled = true;
+    btn.textContent = 'Loading...';
+    
+    try {
+        const posts = await apiCall(`${API_BASE}/posts?limit=${PAGE_SIZE}&before_id=${oldestPostId}`);
+        btn.remove();
+        appendPosts(posts, posts.length === PAGE_SIZE);
+    } catch (error) {
+        btn.disabled = false;
+        btn.textContent = 'Load more';
+    }
+}
+
+function displayPosts(posts, hasMore) {
+    shownPosts = 0;
     if (!posts.length) {
         FEED.innerHTML = '<div class="loading">No posts yet. Create or search for one!</div>';
         return;
     }
 
-    FEED.innerHTML = posts.map(post => `
+    FEED.innerHTML = '';
+    appendPosts(posts, hasMore);
+}
+
+function appendPosts(posts, hasMore) {
+    if (posts.length) {
+        shownPosts += posts.length;
+        oldestPostId = posts[posts.length - 1].id;
+    }
+
+    FEED.insertAdjacentHTML('beforeend', posts.map(post => `
         <div class="post" id="post-${post.id}">
             <div class="post-header">
                 <span class="post-author">
@@ -52,7 +90,12 @@ function displayPosts(posts) {
                 <button class="reply-btn" onclick="addComment(${post.id})">Reply</button>
             </div>
         </div>
-    `).join('');
+    `).join(''));
+    
+    // A full page means there may be older posts
+    if (hasMore) {
+        FEED.insertAdjacentHTML('beforeend', '<button id="loadMoreBtn" class="load-more-btn" onclick="loadMorePosts()">Load more</button>');
+    }
     
     posts.forEach(p => setTimeout(() => loadComments(p.id), 300));
 }
@@ -63,23 +106,45 @@ function escapeHtml(text) {
     return div.innerHTML;
 }
 
+function renderComments(postId, comments) {
+    const html = comments.map(c => `
+        <div class="comment">
+            <div class="comment-author">${escapeHtml(c.author)}</div>
+            <div class="comment-content">${escapeHtml(c.content)}</div>
+        </div>
+    `).join('');
+    
+    // A full page means there may be later comments
+    if (comments.length < COMMENTS_PAGE_SIZE) return html;
+    const lastId = comments[comments.length - 1].id;
+    return html + `<button class="refresh-btn" id="more-comments-${postId}" onclick="loadMoreComments(${postId}, ${lastId})">Show more comments</button>`;
+}
+
 async function loadComments(postId) {
     const container = document.getElementById(`comments-${postId}`);
     try {
-        const comments = await apiCall(`${API_BASE}/posts/${postId}/comments`);
+        const comments = await apiCall(`${API_BASE}/posts/${postId}/comments?limit=${COMMENTS_PAGE_SIZE}`);
         container.innerHTML = comments.length ? 
-            comments.map(c => `
-                <div class="comment">
-                    <div class="comment-author">${escapeHtml(c.author)}</div>
-                    <div class="comment-content">${escapeHtml(c.content)}</div>
-                </div>
-            `).join('') : 
+            renderComments(postId, comments) : 
             '<div style="color: #65676b; font-size: 14px; padding: 10px;">No comments yet. Be the first!</div>';
     } catch (error) {
         container.innerHTML = '<div style="color: red;">❌ Failed to load comments</div>';
     }
 }
 
+async function loadMoreComments(postId, afterId) {
+    const btn = document.getElementById(`more-comments-${postId}`);
+    btn.disabled = true;
+    
+    try {
+        const comments = await apiCall(`${API_BASE}/posts/${postId}/comments?limit=${COMMENTS_PAGE_SIZE}&after_id=${afterId}`);
+        btn.insertAdjacentHTML('beforebegin', renderComments(postId, comments));
+        btn.remove();
+    } catch (error) {
+        btn.disabled = false;
+    }
+}
+
 async function createPost() {
     const content = document.getElementById('postContent').value.trim();
     const author = document.getElementById('postAuthor').value.trim() || 'Anonymous';